@@ -27,27 +27,57 @@ and executes data processing commands based on the specified experiment method (
 
 """
 import logging
-import yaml
 import os
 import sys
 from datetime import datetime
-import glob
 import re
-from string import Template
 import shutil
 import subprocess
-import shlex
 import time
+import threading
+import functools
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import json
+import mmap
 import argparse
 from utils.serial import serial_processing
 from utils.wedges import wedges_processing
 from utils.rotational import rotational_processing
 from utils.log_setup import setup_logger
+from utils.parse_cache import load_yaml, load_json, load_yaml_text
+from utils.extract import find_line
+from utils.watch import wait_for_path
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+logger = logging.getLogger('app')
 
 #This is needed to check the number of running/pending processes
 CURRENT_PATH_OF_SCRIPT = os.path.dirname(__file__)
+TEMPLATES_FOLDER = os.path.join(CURRENT_PATH_OF_SCRIPT, 'templates')
+# Placeholders of the configuration template and the files they are filled with
+_SUBS = [
+    ("$XDS_INP_template", os.path.join(TEMPLATES_FOLDER, 'XDS.INP')),
+    ("$XDS_INP_wedges_template", os.path.join(TEMPLATES_FOLDER, 'XDS_WEDGES.INP')),
+    ("$geometry_for_processing", os.path.join(TEMPLATES_FOLDER, 'pilatus6M.geom')),
+]
 MAX_PENDING_JOBS = 200
+PENDING_JOBS_TTL = 5 # [s]
+
+_pending_cache = {"t": float("-inf"), "n": 0}
+_pending_lock = threading.Lock()
+# Number of dataset folders inspected in parallel in offline mode
+MAX_PARALLEL_RUNS = 16
+RAW_DIRECTORY_POLL_INTERVAL = 1 # [s]
+# Searched directly in the mapped info.txt, the key may come in any case
+FRAMES_PER_POSITION_RE = re.compile(rb'frames/position:', re.IGNORECASE)
+# Interval between retries of dataset folders deferred by run()
+DEFERRED_RETRY_INTERVAL = 30 # [s]
 
 class CustomFormatter(argparse.RawDescriptionHelpFormatter,
                     argparse.ArgumentDefaultsHelpFormatter):
@@ -92,7 +122,6 @@ def serial_start(
     geometry_filename_template = configuration["crystallography"]["geometry_for_processing"]
     
     data_h5path = configuration['crystallography']['data_h5path'] 
-    logger = logging.getLogger('app')
     logger.info(f'INFO: Running serial_processing')
     serial_processing(
         folder_with_raw_data=folder_with_raw_data,
@@ -136,7 +165,6 @@ def xds_start(
     command_for_processing_rotational = configuration['crystallography']['command_for_processing_rotational']
     XDS_INP_template = configuration['crystallography']['XDS_INP_template']
 
-    logger = logging.getLogger('app')
     logger.info(f'INFO: Running rotational_processing')
 
     rotational_processing(
@@ -181,73 +209,94 @@ def wedges_xds_start(
     command_for_processing_rotational = configuration['crystallography']['command_for_processing_rotational']
     XDS_INP_wedges_template = configuration['crystallography']['XDS_INP_wedges_template']
 
-    logger = logging.getLogger('app')
     logger.info(f'INFO: Running wedges_processing')
 
     wedges_processing(folder_with_raw_data, current_data_processing_folder,
                     ORGX, ORGY, distance_offset, command_for_processing_rotational, 
                     XDS_INP_wedges_template, reference_dataset, user, reserved_nodes, 
-                    slurm_partition, sshPrivateKeyPath, sshPublicKeyPath)
+                    slurm_partition, sshPrivateKeyPath, sshPublicKeyPath, is_force=is_force)
 
-def run(root, configuration, is_force, is_maxwell):
-    """Main processing entry point for one dataset folder."""
-    logger = logging.getLogger('app')
+def get_pending_jobs(user, ttl=PENDING_JOBS_TTL):
+    """Returns the number of pending SLURM jobs of the user, querying squeue at most once per ttl seconds.
+    Pending job arrays are expanded (-r), so every array task counts as one job.
+    """
+    with _pending_lock:
+        now = time.monotonic()
+        if now - _pending_cache["t"] < ttl:
+            return _pending_cache["n"]
+        try:
+            out = subprocess.check_output(['squeue', '-u', user, '-t', 'pending', '-r', '-h', '-o', '%i'])
+            n = out.count(b'\n')
+        except subprocess.CalledProcessError:
+            n = 0
+        _pending_cache.update(t=now, n=n)
+        return n
+
+def run(root, configuration, is_force, is_maxwell, pending_count=None):
+    """Main processing entry point for one dataset folder.
+    Returns False if the folder has to be retried later: its info.txt is not usable yet
+    or too many SLURM jobs are pending. Otherwise returns True.
+    """
     logger.info(f'We are here: {root}')
     raw_dir = configuration['crystallography']['raw_directory']
     proc_dir = configuration['crystallography']['processed_directory']
     user = configuration['user']
-    
-    files = [f for f in os.listdir(root) if os.path.isfile(os.path.join(root, f))]
-    info_path = os.path.join(root, 'info.txt')
-    if not (os.path.exists(info_path) and os.path.getsize(info_path) > 0 and len(files) > 1):
-        logger.info(f"In {root} there is no usable info.txt file.")
-        return
-    
-    frames_per_position = 1  # Default value
-    # Read experiment method and frames/position
-    with open(info_path, 'r') as f:
-        method = next(f).split(':')[-1].strip()
-        for line in f:
-            if 'frames/position:' in line.lower():
-                frames_per_position = int(line.split(':')[-1].strip())
-                break
 
     subpath = root[len(raw_dir):].lstrip(os.sep)
     proc_subpath = os.path.join(proc_dir, subpath)
 
-    logger.info(f'Processing {proc_subpath} with method: {method}')
-
-    if not os.path.exists(proc_subpath):
-        os.makedirs(proc_subpath, exist_ok=True)
-        os.chmod(proc_subpath, 0o777)
-
-    # Get pending SLURM jobs
-    try:
-        pending_cmd = f'squeue -u {user} -t pending'
-        pending_jobs = subprocess.check_output(shlex.split(pending_cmd)).decode().splitlines()
-    except subprocess.CalledProcessError:
-        pending_jobs = []
-
     # Handle forced re-processing
     flag_file = os.path.join(proc_subpath, 'flag.txt')
     if is_force and os.path.exists(flag_file):
-        for f in os.listdir(proc_subpath):
-            f_path = os.path.join(proc_subpath, f)
-            try:
-                if os.path.isfile(f_path) or os.path.islink(f_path):
-                    os.unlink(f_path)
-                elif os.path.isdir(f_path):
-                    shutil.rmtree(f_path)
-            except Exception as e:
-                logger.warning(f'Failed to delete {f_path}: {e}')
+        shutil.rmtree(proc_subpath, ignore_errors=True)
+        os.makedirs(proc_subpath, exist_ok=True)
+        os.chmod(proc_subpath, 0o777)
         logger.info(f'Cleared old results in {proc_subpath}')
 
-    # Skip if already processed or SLURM overloaded
-    if os.path.exists(flag_file) or len(pending_jobs) > MAX_PENDING_JOBS or \
+    # Skip if already processed, before touching the raw folder or SLURM
+    if os.path.exists(flag_file) or \
         os.path.exists(os.path.join(proc_subpath, 'CORRECT.LP')) or \
         os.path.exists(os.path.join(proc_subpath, 'XYCORR.LP')):
         logger.info(f'{proc_subpath} is skipped')
-        
+        return True
+
+    # Only need to know whether there are at least two files, d_type from readdir is enough
+    n_files = 0
+    with os.scandir(root) as it:
+        for entry in it:
+            if entry.is_file(follow_symlinks=False):
+                n_files += 1
+                if n_files >= 2:
+                    break
+    info_path = os.path.join(root, 'info.txt')
+    if not (n_files >= 2 and os.path.exists(info_path) and os.path.getsize(info_path) > 0):
+        logger.info(f"In {root} there is no usable info.txt file.")
+        # Without info.txt this is not a dataset folder (yet), its creation triggers a new run
+        return not os.path.exists(info_path)
+    
+    frames_per_position = 1  # Default value
+    # Read experiment method and frames/position
+    with open(info_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        first_nl = mm.find(b'\n')
+        if first_nl < 0:
+            first_nl = len(mm)
+        method = mm[:first_nl].split(b':')[-1].strip().decode()
+        found = find_line(mm, FRAMES_PER_POSITION_RE, first_nl)
+        if found is not None:
+            frames_per_position = int(mm[found[0]:found[1]].split(b':')[-1])
+
+    # Skip if SLURM overloaded
+    if pending_count is None:
+        pending_count = get_pending_jobs(user)
+    if pending_count > MAX_PENDING_JOBS:
+        logger.info(f'{proc_subpath} is skipped, {pending_count} jobs are pending')
+        return False
+
+    logger.info(f'Processing {proc_subpath} with method: {method}')
+
+    if not os.path.exists(proc_subpath):
+        os.makedirs(proc_subpath, exist_ok=True)
+        os.chmod(proc_subpath, 0o777)
 
     if method == 'rotational':
         logger.info(f"XDS: {root}")
@@ -258,11 +307,137 @@ def run(root, configuration, is_force, is_maxwell):
     else:
         logger.info(f"SERIAL: {root}")
         serial_start(root, proc_subpath, configuration, is_force, is_maxwell)
+    return True
+
+
+def run_many(executor, roots, configuration, is_force, is_maxwell, pending_count=None):
+    """Runs run() for several dataset folders concurrently and waits for all of them.
+    Worker processes are used rather than threads because rotational_processing and
+    wedges_processing temporarily set os.umask(0), which is shared by all threads of a process.
+    Returns the folders deferred by run(); folders whose processing failed are logged and dropped.
+    """
+    futures = {
+        executor.submit(run, root, configuration, is_force, is_maxwell, pending_count): root
+        for root in roots
+    }
+    deferred = []
+    for future in as_completed(futures):
+        root = futures[future]
+        if run_result(root, future) is False:
+            deferred.append(root)
+    return deferred
+
+def run_result(root, future):
+    """Returns the result of a run() future, or None if the processing of root failed."""
+    try:
+        is_done = future.result()
+    except (Exception, SystemExit):
+        # serial_data_processing may sys.exit, one folder must not stop the whole scan
+        logger.exception(f'ERROR: Processing of {root} failed')
+        return None
+    if is_done:
+        logger.info(f'INFO: Processed {root}')
+    return is_done
+
+class InfoFileHandler(FileSystemEventHandler):
+    """Starts processing of a dataset folder once its info.txt has been written.
+    Folders are processed in the executor, at most once at a time. Folders deferred by run(),
+    or requested again while still being processed, are collected for watch_raw_directory to retry.
+    """
 
+    def __init__(self, executor, configuration, is_force, is_maxwell):
+        super().__init__()
+        self.executor = executor
+        self.configuration = configuration
+        self.is_force = is_force
+        self.is_maxwell = is_maxwell
+        self._running = set()
+        self._deferred = set()
+        self._lock = threading.Lock()
+
+    def submit(self, root, pending_count=None):
+        """Processes root in the executor unless it is already being processed."""
+        with self._lock:
+            if root in self._running:
+                self._deferred.add(root)
+                return
+            self._running.add(root)
+            self._deferred.discard(root)
+        future = self.executor.submit(run, root, self.configuration, self.is_force, self.is_maxwell, pending_count)
+        future.add_done_callback(functools.partial(self._done, root))
+
+    def _done(self, root, future):
+        is_done = run_result(root, future)
+        with self._lock:
+            self._running.discard(root)
+            if is_done is False:
+                self._deferred.add(root)
+
+    def take_deferred(self):
+        """Returns the deferred folders and forgets them."""
+        with self._lock:
+            deferred, self._deferred = self._deferred, set()
+        return sorted(deferred)
+
+    def _process(self, path):
+        if os.path.basename(path) == 'info.txt':
+            self.submit(os.path.dirname(path))
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self._process(event.src_path)
+
+    def on_closed(self, event):
+        self._process(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self._process(event.dest_path)
+
+def watch_raw_directory(raw_directory, configuration, is_force, is_maxwell):
+    """Processes the existing folders once, then reacts to new info.txt files via inotify.
+    The observer is started before the initial walk, so folders created during the walk are not missed.
+    Folders deferred by run() are retried every DEFERRED_RETRY_INTERVAL seconds.
+    """
+    user = configuration['user']
+    with ProcessPoolExecutor(max_workers=MAX_PARALLEL_RUNS) as executor:
+        # With fork, the first submit starts all workers: do it before the observer thread exists
+        executor.submit(int).result()
+        handler = InfoFileHandler(executor, configuration, is_force, is_maxwell)
+        observer = Observer()
+        observer.schedule(handler, raw_directory, recursive=True)
+        observer.start()
+        logger.info(f'Watching {raw_directory} for new datasets')
+        try:
+            pending_count = get_pending_jobs(user)
+            for root, dirs, files in os.walk(raw_directory):
+                handler.submit(root, pending_count)
+            next_retry = time.monotonic() + DEFERRED_RETRY_INTERVAL
+            while observer.is_alive():
+                observer.join(1)
+                if time.monotonic() < next_retry:
+                    continue
+                deferred = handler.take_deferred()
+                if deferred:
+                    logger.info(f'Retrying {len(deferred)} deferred folders')
+                    pending_count = get_pending_jobs(user)
+                    for root in deferred:
+                        handler.submit(root, pending_count)
+                next_retry = time.monotonic() + DEFERRED_RETRY_INTERVAL
+        finally:
+            observer.stop()
+            observer.join()
+
+def iter_metadata_files(base_path):
+    """Yields paths of beamtime-metadata*.json files located directly in base_path."""
+    with os.scandir(base_path) as it:
+        for entry in it:
+            if entry.name.startswith('beamtime-metadata') and entry.name.endswith('.json') and entry.is_file():
+                yield entry.path
 
 def find_and_parse_metadata(base_path):
     """Finds and parses the first valid beamtime-metadata*.json file in the given directory.
-    This function searches recursively for files matching the pattern beamtime-metadata*.json
+    This function searches the directory for files matching the pattern beamtime-metadata*.json
     and returns the first one that contains the required fields: beamtimeId and onlineAnalysis.
     If no such file is found, it raises a FileNotFoundError.
     If the file is found but does not contain the required fields, it skips that file and continues searching.
@@ -280,20 +455,23 @@ def find_and_parse_metadata(base_path):
         sshPublicKeyPath: shared/id_rsa.pub
         userAccount: bttest04
     """
-    logger = logging.getLogger('app')
     logger.info("Parsing metadata...")
-    # Recursive search for files like beamtime-metadata*.json
+    # Search for files like beamtime-metadata*.json
     base_path = base_path.split('/raw')[0] if '/raw' in base_path else base_path
     
     if not os.path.exists(base_path):  # Check if the base path exists
         raise FileNotFoundError(f"The base path {base_path} does not exist.")
-    pattern = os.path.join(f"{base_path}", "beamtime-metadata*.json")
-    json_files = glob.glob(pattern, recursive=True)
-    
-    for json_file in json_files:
+    return dict(_parse_metadata_directory(base_path, os.stat(base_path).st_mtime_ns))
+
+@functools.lru_cache(maxsize=8)
+def _parse_metadata_directory(base_path, mtime_ns):
+    """Does the actual search for find_and_parse_metadata.
+    The directory mtime is part of the cache key, so adding, removing or renaming
+    metadata files invalidates the cached result.
+    """
+    for json_file in iter_metadata_files(base_path):
         try:
-            with open(json_file, "r") as f:
-                data = json.load(f)
+            data = load_json(json_file)
 
             # Ensure required keys exist
             if all(k in data for k in ["beamtimeId", "onlineAnalysis"]):
@@ -327,7 +505,6 @@ def filling_configuration_file(configuration_file_template, processed_directory=
     Returns:
     - str: Path to the actual configuration YAML file to use.
     """
-    logger = logging.getLogger('app')
     
     with open(configuration_file_template, "r") as f:
         template_text = f.read()
@@ -336,19 +513,14 @@ def filling_configuration_file(configuration_file_template, processed_directory=
     if "$" not in template_text:
         return configuration_file_template  # Not a template
 
-    templates_folder = os.path.join(CURRENT_PATH_OF_SCRIPT, 'templates')
-    values = {
-        "XDS_INP_template": os.path.join(templates_folder, 'XDS.INP'),
-        "XDS_INP_wedges_template": os.path.join(templates_folder, 'XDS_WEDGES.INP'),
-        "geometry_for_processing": os.path.join(templates_folder, 'pilatus6M.geom')
-    }
-
-    filled_template = Template(template_text).safe_substitute(values)
+    filled_template = template_text
+    for placeholder, value in _SUBS:
+        filled_template = filled_template.replace(placeholder, value)
 
     # Try to extract processed_directory from filled content if not given
     if processed_directory is None:
         try:
-            temp_config = yaml.safe_load(filled_template)
+            temp_config = load_yaml_text(filled_template)
             processed_directory = temp_config['crystallography']['processed_directory']
             os.makedirs(processed_directory, exist_ok=True)
             os.chmod(processed_directory, 0o777)
@@ -389,8 +561,7 @@ def main():
     #If the configuration file is a template, we fill it with values from the beamtime JSON file
     configuration_file = filling_configuration_file(configuration_file) 
 
-    with open(configuration_file,'r') as file:
-        configuration = yaml.safe_load(file)
+    configuration = load_yaml(configuration_file)
 
     raw_directory = configuration['crystallography']['raw_directory']
     processed_directory = configuration['crystallography']['processed_directory']
@@ -400,16 +571,13 @@ def main():
     is_maxwell = args.maxwell
 
     
-    while True: 
-        #Wait while the directory with raw data appeared
-        if os.path.exists(raw_directory):
-            break
+    #Wait while the directory with raw data appeared
+    wait_for_path(raw_directory, RAW_DIRECTORY_POLL_INTERVAL)
 
     #Creating the folder structure for processed data
     creating_folder_structure(processed_directory)
 
     setup_logger(processed_directory)
-    logger = logging.getLogger('app')
     
     result_parsed_metadata = find_and_parse_metadata(raw_directory)
     
@@ -446,18 +614,22 @@ def main():
                         to_process.append(line)
             
 
-            for root, dirs, files in os.walk(raw_directory):
-                for pattern in to_process:
-                    
-                    if pattern in root[len(raw_directory):]:
-                        run(root, configuration, is_force, is_maxwell)
-                        logger.info(f'INFO: Processed {root}')
+            pending_count = get_pending_jobs(user)
+            roots = [
+                root for root, dirs, files in os.walk(raw_directory)
+                if any(pattern in root[len(raw_directory):] for pattern in to_process)
+            ]
+            with ProcessPoolExecutor(max_workers=MAX_PARALLEL_RUNS) as executor:
+                run_many(executor, roots, configuration, is_force, is_maxwell, pending_count)
+        elif Observer is not None:
+            watch_raw_directory(raw_directory, configuration, is_force, is_maxwell)
         else:
-            while True: #main cycle for inspection folders and running data processing
-                for root, dirs, files in os.walk(raw_directory):
-                    run(root, configuration, is_force, is_maxwell)
-                    logger.info(f'INFO: Processed {root}')
-                time.sleep(2)
+            with ProcessPoolExecutor(max_workers=MAX_PARALLEL_RUNS) as executor:
+                while True: #main cycle for inspection folders and running data processing
+                    pending_count = get_pending_jobs(user)
+                    roots = [root for root, dirs, files in os.walk(raw_directory)]
+                    run_many(executor, roots, configuration, is_force, is_maxwell, pending_count)
+                    time.sleep(2)
     else:
         if args.path is None:
             logger.error('ERROR: YOU HAVE TO GIVE THE ABSOLUTE PATH TO THE RAW FOLDER YOU ARE GOING TO PROCESS IF YOU ARE IN THIS MODE!')
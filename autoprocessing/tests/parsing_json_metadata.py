@@ -2,6 +2,11 @@ import os
 import json
 import glob
 
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
 def find_and_parse_metadata(base_path):
     # Recursive search for files like beamtime-metadata*.json
     pattern = os.path.join(base_path, "**", "beamtime-metadata*.json")
@@ -9,8 +14,8 @@ def find_and_parse_metadata(base_path):
 
     for json_file in json_files:
         try:
-            with open(json_file, "r") as f:
-                data = json.load(f)
+            with open(json_file, "rb") as f:
+                data = _json_loads(f.read())
 
             # Ensure required keys exist
             if all(k in data for k in ["beamtimeId", "onlineAnalysis"]):
@@ -1,10 +1,19 @@
 import os
 import shutil
 import re
-import fabio
+import functools
 from pathlib import Path
 import time
 
+# The binary image follows this marker; everything before it is the ASCII header
+CBF_BINARY_START = b"\x0c\x1a\x04\xd5"
+HEADER_CHUNK_SIZE = 8192
+MAX_HEADER_SIZE = 1 << 20
+
+_FASTEST_DIM_RE = re.compile(rb"X-Binary-Size-Fastest-Dimension:\s*(\d+)")
+_SECOND_DIM_RE = re.compile(rb"X-Binary-Size-Second-Dimension:\s*(\d+)")
+_PIX_RE = re.compile(rb"Pixel_size\s+([\deE\.\-]+)\s*m\s*x\s*([\deE\.\-]+)\s*m")
+
 def wait_until_file_is_readable(filepath, timeout=10):
     """Wait until a file is readable.
     Args:
@@ -22,6 +31,27 @@ def wait_until_file_is_readable(filepath, timeout=10):
             time.sleep(0.5)  # Wait and retry
 
 
+def read_cbf_header(cbf_file):
+    """Read the ASCII header of a CBF file without touching the pixel data.
+    Args:
+        cbf_file (str): Path to the CBF file.
+    Returns:
+        bytes: Everything in the file before the start of the binary section.
+    """
+    header = b""
+    with open(cbf_file, 'rb') as f:
+        while len(header) < MAX_HEADER_SIZE:
+            chunk = f.read(HEADER_CHUNK_SIZE)
+            if not chunk:
+                break
+            # Search from the end of the previous chunk in case the marker is split
+            start = max(len(header) - len(CBF_BINARY_START), 0)
+            header += chunk
+            end = header.find(CBF_BINARY_START, start)
+            if end >= 0:
+                return header[:end]
+    return header
+
 def retrieving_info_from_cbf(cbf_file):
     """Retrieve pixel size and dimensions from a CBF file.
     Args:
@@ -32,20 +62,23 @@ def retrieving_info_from_cbf(cbf_file):
         TimeoutError: If the file is not readable within the specified timeout.
     """
     wait_until_file_is_readable(cbf_file, timeout=30)
-    img = fabio.open(cbf_file)
-    header = img.header
-    if "X-Binary-Size-Fastest-Dimension" not in header or "X-Binary-Size-Second-Dimension" not in header:
+    st = os.stat(cbf_file)
+    return _retrieving_info_from_cbf(os.fspath(cbf_file), st.st_mtime_ns, st.st_size)
+
+@functools.lru_cache(maxsize=64)
+def _retrieving_info_from_cbf(cbf_file, mtime_ns, size):
+    header = read_cbf_header(cbf_file)
+    fastest_dim = _FASTEST_DIM_RE.search(header)
+    second_dim = _SECOND_DIM_RE.search(header)
+    pixel_size = 0.000172  # Default value
+    if fastest_dim is None or second_dim is None:
         print(f"Error: Missing X-Binary-Size headers in {cbf_file}")
         N_PIXELS_TO_THE_SHORT_EDGE = 2462  # Default value
         N_PIXELS_TO_THE_LONG_EDGE = 2526   # Default value
-        pixel_size = 0.000172  # Default value
     else:
-        N_PIXELS_TO_THE_SHORT_EDGE = float(header["X-Binary-Size-Fastest-Dimension"])
-        N_PIXELS_TO_THE_LONG_EDGE = float(header["X-Binary-Size-Second-Dimension"])
-        lines = header["_array_data.header_contents"].splitlines()
-        pixel_line = next((line for line in lines if "Pixel_size" in line), None)
-        match = re.search(r"Pixel_size\s+([\deE\.\-]+)\s*m\s*x\s*([\deE\.\-]+)\s*m", pixel_line)
+        N_PIXELS_TO_THE_SHORT_EDGE = float(fastest_dim.group(1))
+        N_PIXELS_TO_THE_LONG_EDGE = float(second_dim.group(1))
+        match = _PIX_RE.search(header)
         if match:
             pixel_size = float(match.group(1))
-    img.close()    
     return N_PIXELS_TO_THE_SHORT_EDGE, N_PIXELS_TO_THE_LONG_EDGE, pixel_size
@@ -1,5 +1,39 @@
+import os
 import re
-    
+import functools
+
+_NUM_RE = re.compile(r"[-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?")
+
+def find_line(mm, needle, start=0):
+    """Find the first line of a mapped file containing needle.
+    Args:
+        mm (mmap.mmap or bytes): Content of the file.
+        needle (bytes or re.Pattern): The byte string or compiled bytes pattern to search for.
+        start (int): Offset to start searching from.
+    Returns:
+        tuple: (line_start, line_end) offsets of the matching line, or None if not found.
+    """
+    if isinstance(needle, re.Pattern):
+        match = needle.search(mm, start)
+        if match is None:
+            return None
+        i = match.start()
+    else:
+        i = mm.find(needle, start)
+        if i < 0:
+            return None
+    line_start = mm.rfind(b"\n", 0, i) + 1
+    line_end = mm.find(b"\n", i)
+    if line_end < 0:
+        line_end = len(mm)
+    return line_start, line_end
+
+@functools.lru_cache(maxsize=32)
+def _read_info(path, mtime_ns):
+    """Read info.txt once per modification; keys are matched as substrings, so the lines are kept as is."""
+    with open(path, "r", errors="replace") as f:
+        return tuple(f.read().splitlines())
+
 def extract_value_from_info(info_path, key, fallback=None, is_float=True, is_string=False):
     """Extract a value from the info.txt file based on the provided key.
     Args:
@@ -15,18 +49,18 @@ def extract_value_from_info(info_path, key, fallback=None, is_float=True, is_str
         fallback = "" if is_string else 0
 
     try:
-        with open(info_path) as f:
-            lines = f.readlines()
-        for line in lines:
-            if key in line:
-                if is_string:
-                    # Get value after the first colon, trim whitespace
-                    return line.split(":", 1)[-1].strip()
-                else:
-                    match = re.search(r"[-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?", line)
-                    if match:
-                        return float(match.group()) if is_float else int(float(match.group()))
-    except Exception:
-        pass
+        lines = _read_info(os.fspath(info_path), os.stat(info_path).st_mtime_ns)
+    except OSError:
+        return fallback
+
+    for line in lines:
+        if key not in line:
+            continue
+        if is_string:
+            # Get value after the first colon, trim whitespace
+            return line.split(":", 1)[-1].strip()
+        match = _NUM_RE.search(line)
+        if match:
+            return float(match.group()) if is_float else int(float(match.group()))
 
     return fallback
@@ -1,8 +1,18 @@
 import logging
 import os
+import functools
+from pathlib import Path
 
+def find_processed_root(path):
+    """Return the top-most 'processed' folder containing path, or path itself if there is none."""
+    path = Path(path)
+    return next((folder for folder in reversed([path, *path.parents]) if folder.name == 'processed'), path)
+
+@functools.lru_cache(maxsize=32)
 def setup_logger(log_dir=None, log_name="Auto-processing-P09-beamline"):
-    
+    """Return the logger log_name writing to log_dir/log_name.log.
+    Cached, so repeated calls for the same folder reuse the logger instead of opening the file again.
+    """
     level = logging.INFO
     logger = logging.getLogger(log_name)
     logger.setLevel(level)
@@ -13,15 +23,13 @@ def setup_logger(log_dir=None, log_name="Auto-processing-P09-beamline"):
     os.makedirs(log_dir, exist_ok=True)
     log_file = os.path.join(log_dir, f'{log_name}.log')
 
-    formatter = logging.Formatter('%(levelname)s - %(message)s')
-    ch = logging.FileHandler(log_file)
-    ch.setLevel(level)
-    ch.setFormatter(formatter)
-
     if not logger.handlers:  # avoid adding multiple handlers in re-runs
+        formatter = logging.Formatter('%(levelname)s - %(message)s')
+        ch = logging.FileHandler(log_file)
+        ch.setLevel(level)
+        ch.setFormatter(formatter)
         logger.addHandler(ch)
 
     logger.info(f"Setup logger in PID {os.getpid()}")
     print(f"Log file is {log_file}")
     return logger
-
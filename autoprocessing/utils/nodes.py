@@ -1,8 +1,32 @@
 import os
-import subprocess
+import time
+import shutil
 import shlex
+import functools
+import subprocess
+from string import Template
 
 LIMIT_FOR_RESERVED_NODES = 1000
+NODES_CHECK_TTL = 30 # [s]
+# Resolved once so submissions can exec sbatch directly without a shell
+SBATCH = shutil.which("sbatch") or "sbatch"
+
+# Lines every job script starts with; job specific options follow it
+SLURM_HEADER = Template(
+    "#!/bin/sh\n"
+    "#SBATCH --job-name=$job_name\n"
+    "#SBATCH --partition=$partition\n"
+    "#SBATCH --nodes=1\n"
+    "#SBATCH --output=$out_file\n"
+    "#SBATCH --error=$err_file\n"
+)
+
+def get_login_node(reserved_nodes):
+    """Return the node jobs for the reservation are submitted from over ssh, or None on maxwell."""
+    if "maxwell" in reserved_nodes:
+        return None
+    return reserved_nodes.split(",", 1)[0]
+
 def are_the_reserved_nodes_overloaded(node_list):
     """Check if the reserved nodes are overloaded by counting running jobs.
     Args:
@@ -11,8 +35,32 @@ def are_the_reserved_nodes_overloaded(node_list):
         bool: True if the number of jobs exceeds the limit, False otherwise.
     """
     try:
-        jobs_cmd = f'squeue -w {node_list}'
-        all_jobs = subprocess.check_output(shlex.split(jobs_cmd)).decode().splitlines()
+        # No header and only the job id per line, so the line count is the job count
+        jobs_cmd = ['squeue', '-w', node_list, '-h', '-o', '%i']
+        n_jobs = subprocess.check_output(jobs_cmd).count(b'\n')
     except subprocess.CalledProcessError:
-        all_jobs = []
-    return len(all_jobs) > LIMIT_FOR_RESERVED_NODES
+        n_jobs = 0
+    return n_jobs > LIMIT_FOR_RESERVED_NODES
+
+@functools.lru_cache(maxsize=8)
+def _are_the_reserved_nodes_overloaded(node_list, time_bucket):
+    return are_the_reserved_nodes_overloaded(node_list)
+
+def are_the_reserved_nodes_overloaded_cached(node_list):
+    """Same as are_the_reserved_nodes_overloaded, but reuses the answer for up to NODES_CHECK_TTL seconds."""
+    return _are_the_reserved_nodes_overloaded(node_list, int(time.monotonic() // NODES_CHECK_TTL))
+
+def submit_jobs(slurmfiles, ssh_command=None):
+    """Submit SLURM scripts given by absolute path.
+    With an ssh command (argv list from build_ssh_command) all scripts are submitted by a single
+    remote shell, so the connection and login cost is paid once instead of per script.
+    """
+    if not slurmfiles:
+        return
+    if ssh_command:
+        # Paths are quoted so that spaces or shell metacharacters survive the remote shell
+        script = f"set -e\nfor f in {' '.join(shlex.quote(str(f)) for f in slurmfiles)}; do sbatch \"$f\"; done\n"
+        subprocess.run([*ssh_command, "bash", "-s"], input=script, text=True, check=True)
+    else:
+        for slurmfile in slurmfiles:
+            subprocess.run([SBATCH, str(slurmfile)], check=True)
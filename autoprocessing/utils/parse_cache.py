@@ -0,0 +1,60 @@
+import os
+import copy
+import functools
+import yaml
+
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers catch either the same way
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+
+def _file_key(path):
+    """Return a cache key that changes whenever the file is rewritten."""
+    st = os.stat(path)
+    return os.fspath(path), st.st_mtime_ns, st.st_size
+
+@functools.lru_cache(maxsize=128)
+def _load_yaml_file(path, mtime_ns, size):
+    with open(path, 'r') as f:
+        return yaml.load(f, Loader=_Loader)
+
+@functools.lru_cache(maxsize=128)
+def _load_json_file(path, mtime_ns, size):
+    with open(path, 'rb') as f:
+        return _json_loads(f.read())
+
+@functools.lru_cache(maxsize=32)
+def _load_yaml_text(text):
+    return yaml.load(text, Loader=_Loader)
+
+def load_yaml(path):
+    """Load a YAML file, deserializing it only once while it stays unchanged.
+    Args:
+        path (str): Path to the YAML file.
+    Returns:
+        The parsed document. A copy is returned so callers may modify it freely.
+    """
+    return copy.deepcopy(_load_yaml_file(*_file_key(path)))
+
+def load_json(path):
+    """Load a JSON file, deserializing it only once while it stays unchanged.
+    Args:
+        path (str): Path to the JSON file.
+    Returns:
+        The parsed document. A copy is returned so callers may modify it freely.
+    Raises:
+        FileNotFoundError: If the file does not exist.
+        json.JSONDecodeError: If the file is not valid JSON.
+    """
+    return copy.deepcopy(_load_json_file(*_file_key(path)))
+
+def load_yaml_text(text):
+    """Parse a YAML string, reusing the result for identical content."""
+    return copy.deepcopy(_load_yaml_text(text))
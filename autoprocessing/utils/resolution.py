@@ -11,16 +11,28 @@ def calculation_high_resolution(detector_distance, wavelength, N_pixels_to_the_s
     Returns:
         float: The calculated high resolution in Angstroms.
     """
-    
-    N_pixels_to_the_short_edge //= 2
-    N_pixels_to_the_long_edge //= 2
-
-    distance_to_the_short_edge = pixel_size * N_pixels_to_the_short_edge # [m] 
-    distance_to_the_long_edge = pixel_size * N_pixels_to_the_long_edge # [m]
+    # The resolution decreases monotonically with the distance to the edge,
+    # so the worst (largest) value always belongs to the nearer edge
+    distance_to_the_edge = pixel_size * min(N_pixels_to_the_short_edge // 2, N_pixels_to_the_long_edge // 2) # [m]
 
     detector_distance /= 1000 # m
 
-    resolution_to_the_short_edge = wavelength / (2* math.sin(0.5 * math.atan(distance_to_the_short_edge/detector_distance)))
-    resolution_to_the_long_edge = wavelength / (2* math.sin(0.5 * math.atan(distance_to_the_long_edge/detector_distance)))
+    return wavelength / (2 * math.sin(0.5 * math.atan(distance_to_the_edge / detector_distance)))
+
+def calculation_high_resolution_batch(detector_distances, wavelengths, N_pixels_to_the_short_edge=2462, N_pixels_to_the_long_edge=2526, pixel_size=0.000172):
+    """Vectorized calculation_high_resolution for many frames at once.
+    Args:
+        detector_distances (array-like): Distances from the detector to the sample in mm.
+        wavelengths (array-like): Wavelengths of the X-ray in Angstroms.
+        N_pixels_to_the_short_edge (int): Number of pixels in the X direction.
+        N_pixels_to_the_long_edge (int): Number of pixels in the Y direction.
+    Returns:
+        numpy.ndarray: The calculated high resolutions in Angstroms.
+    """
+    import numpy as np
+
+    distance_to_the_edge = pixel_size * min(N_pixels_to_the_short_edge // 2, N_pixels_to_the_long_edge // 2) # [m]
+    detector_distances = np.asarray(detector_distances, dtype=float) / 1000 # m
+    wavelengths = np.asarray(wavelengths, dtype=float)
 
-    return max(resolution_to_the_short_edge, resolution_to_the_long_edge)
+    return wavelengths / (2 * np.sin(0.5 * np.arctan(distance_to_the_edge / detector_distances)))
@@ -8,93 +8,96 @@ import glob
 import time
 import re
 import shutil
-import subprocess
 import logging
+import functools
 from string import Template
 from pathlib import Path
-import shlex
-from utils.nodes import are_the_reserved_nodes_overloaded
+from utils.nodes import are_the_reserved_nodes_overloaded_cached, submit_jobs, get_login_node, SLURM_HEADER
 from utils.templates import filling_template_rotational
-from utils.log_setup import setup_logger
+from utils.log_setup import setup_logger, find_processed_root
+from utils.ssh import build_ssh_command
 
 time_to_wait_appearing_raw_folder = 20
 
-def build_ssh_command(user, sshPrivateKeyPath, login_node):
-    return (
-        f"/usr/bin/ssh -o BatchMode=yes -o CheckHostIP=no -o StrictHostKeyChecking=no "
-        f"-o GSSAPIAuthentication=no -o GSSAPIDelegateCredentials=no -o PasswordAuthentication=no "
-        f"-o PubkeyAuthentication=yes -o PreferredAuthentications=publickey -o ConnectTimeout=10 "
-        f"-l {user} -i {sshPrivateKeyPath} {login_node}"
-    )
+_MASTER_RE = re.compile(r'_master\.')
+_DIGITS_RE = re.compile(r'(\d+)\.')
+
+@functools.lru_cache(maxsize=16)
+def _wildcard(n):
+    """Return the XDS wildcard replacing a frame number of n digits."""
+    return '?' * n + '.'
+
+def _digits_to_wildcard(match):
+    return _wildcard(len(match.group(1)))
+
+def _is_frame_file(name):
+    """Return True for a .cbf frame or an .h5/.cxi master file."""
+    return name.endswith(".cbf") or name.endswith((".h5", ".cxi")) and 'master' in name
+
+def _first_frame_file(folder):
+    """Return the path of the alphabetically first frame/master file in folder, or None.
+    Only the first file is needed for the template, so no list is built or sorted.
+    """
+    first_name = None
+    with os.scandir(folder) as it:
+        for entry in it:
+            name = entry.name
+            # Name checks first, DirEntry.is_file uses the type from the listing without a stat
+            if (first_name is None or name < first_name) and _is_frame_file(name) and entry.is_file(follow_symlinks=False):
+                first_name = name
+    return os.path.join(folder, first_name) if first_name else None
 
 def build_sbatch_script(job_name, command_for_data_processing, out_file, err_file,
-                        partition, reservation=None, time=None, mem=None, nice=None):
-    lines = [
-        "#!/bin/sh\n",
-        f"#SBATCH --job-name={job_name}\n",
-        f"#SBATCH --partition={partition}\n",
-        "#SBATCH --nodes=1\n",
-        f"#SBATCH --output={out_file}\n",
-        f"#SBATCH --error={err_file}\n",
-    ]
-    if reservation:
-        lines.append(f"#SBATCH --reservation={reservation}\n")
-    if time:
-        lines.append(f"#SBATCH --time={time}\n")
-    if mem:
-        lines.append(f"#SBATCH --mem={mem}\n")
-    if nice:
-        lines.append(f"#SBATCH --nice={nice}\n")
-
-    lines += [
-        "source /etc/profile.d/modules.sh\n",
-        "module load xray autoproc\n",
+                        partition, reservation=None, time=None, mem=None, nice=None, chdir=None):
+    """Return the text of the SLURM script running command_for_data_processing."""
+    options = "".join(
+        f"#SBATCH --{option}={value}\n"
+        for option, value in (("reservation", reservation), ("time", time), ("mem", mem), ("nice", nice), ("chdir", chdir))
+        if value
+    )
+    header = SLURM_HEADER.substitute(job_name=job_name, partition=partition, out_file=out_file, err_file=err_file)
+    return (
+        f"{header}"
+        f"{options}"
+        "source /etc/profile.d/modules.sh\n"
+        "module load xray autoproc\n"
         f"{command_for_data_processing}\n"
-    ]
-    return lines
-
-def xds_start(current_data_processing_folder, command_for_data_processing,
-            user, reserved_nodes, slurm_partition,
-            sshPrivateKeyPath, sshPublicKeyPath,
-            login_node=None):
-    """Prepare and submit the XDS job via SLURM."""
-    os.chdir(current_data_processing_folder)
-    folder = Path(current_data_processing_folder)
+    )
+
+def write_sbatch(current_data_processing_folder, command_for_data_processing,
+                 reserved_nodes, slurm_partition):
+    """Write the SLURM script running command_for_data_processing in current_data_processing_folder.
+    Returns:
+        Path: The script, to be passed to submit_jobs.
+    """
+    folder = Path(current_data_processing_folder).absolute()
     job_name = folder.name
     slurmfile = folder / f"{job_name}_XDS.sh"
     out_file = folder / f"{job_name}_XDS.out"
     err_file = folder / f"{job_name}_XDS.err"
 
     is_maxwell = "maxwell" in reserved_nodes
-    ssh_command = ""
-
-    if login_node:
-        ssh_command = build_ssh_command(user, sshPrivateKeyPath, login_node)
 
     if not is_maxwell:
-        if not are_the_reserved_nodes_overloaded(reserved_nodes):
+        if not are_the_reserved_nodes_overloaded_cached(reserved_nodes):
             sbatch_script = build_sbatch_script(
-                job_name, command_for_data_processing, out_file, err_file,
+                job_name, command_for_data_processing, out_file, err_file, chdir=folder,
                 partition=slurm_partition, reservation=reserved_nodes
             )
         else:
             sbatch_script = build_sbatch_script(
-                job_name, command_for_data_processing, out_file, err_file,
+                job_name, command_for_data_processing, out_file, err_file, chdir=folder,
                 partition="allcpu,upex,short"
             )
     else:
         sbatch_script = build_sbatch_script(
-            job_name, command_for_data_processing, out_file, err_file,
+            job_name, command_for_data_processing, out_file, err_file, chdir=folder,
             partition="allcpu,upex,short", time="8:00:00", mem="500000", nice="100"
         )
 
-    with open(slurmfile, 'w') as fh:
-        fh.writelines(sbatch_script)
+    slurmfile.write_text(sbatch_script)
     os.chmod(slurmfile, 0o755)
-
-    # Submit the job
-    submit_command = f'{ssh_command} "sbatch {slurmfile}"' if ssh_command else f'sbatch {slurmfile}'
-    subprocess.run(submit_command, shell=True, check=True)
+    return slurmfile
 
 def rotational_processing(
     folder_with_raw_data, current_data_processing_folder, ORGX, ORGY,
@@ -108,60 +111,52 @@ def rotational_processing(
         
     
     # Setup logger
-    logger = setup_logger(log_dir=current_data_processing_folder.split('processed')[0] + 'processed', log_name="rotational_processing")
+    logger = setup_logger(log_dir=str(find_processed_root(current_data_processing_folder)), log_name="rotational_processing")
     
     logger.info("Starting rotational data processing...")
     logger.info(f"Processing folder: {folder_with_raw_data}")
     logger.info(f"Current data processing folder: {current_data_processing_folder}")
     logger.info(f"Geometry template: {XDS_INP_template}")
     
-    # Create necessary directories
-    os.makedirs(current_data_processing_folder, exist_ok=True)
-    os.chmod(current_data_processing_folder, 0o777)
-    os.makedirs(os.path.join(current_data_processing_folder, 'xds'), exist_ok=True)
-    os.chmod(os.path.join(current_data_processing_folder, 'xds'), 0o777)
-
+    # Create necessary directories, world-writable straight away instead of chmod afterwards
     timestamp = time.strftime("%Y%m%d-%H%M%S")
     unique_dir = os.path.join(current_data_processing_folder, f'autoPROC_{timestamp}')
-    os.makedirs(unique_dir, exist_ok=True)
-    os.chmod(unique_dir, 0o777)
+    old_umask = os.umask(0)
+    try:
+        os.makedirs(os.path.join(current_data_processing_folder, 'xds'), mode=0o777, exist_ok=True)
+        os.makedirs(unique_dir, mode=0o777, exist_ok=True)
+    finally:
+        os.umask(old_umask)
     
     ORGX = float(ORGX) if ORGX != "None" else 0
     ORGY = float(ORGY) if ORGY != "None" else 0
     distance_offset = float(distance_offset)
 
-    res = [
-        os.path.join(folder_with_raw_data, file)
-        for file in os.listdir(folder_with_raw_data)
-        if os.path.isfile(os.path.join(folder_with_raw_data, file)) and (
-            (file.endswith(".h5") or file.endswith(".cxi")) and 'master' in file or file.endswith(".cbf"))
-    ]
-    res.sort()
+    first_frame = _first_frame_file(folder_with_raw_data)
 
-    if res:
-        NAME_TEMPLATE_OF_DATA_FRAMES = res[0]
+    if first_frame:
+        NAME_TEMPLATE_OF_DATA_FRAMES = first_frame
         if 'master' in NAME_TEMPLATE_OF_DATA_FRAMES:
-            NAME_TEMPLATE_OF_DATA_FRAMES = re.sub(r'_master\.', '_??????.', NAME_TEMPLATE_OF_DATA_FRAMES)
+            NAME_TEMPLATE_OF_DATA_FRAMES = _MASTER_RE.sub('_??????.', NAME_TEMPLATE_OF_DATA_FRAMES)
         else:
-            NAME_TEMPLATE_OF_DATA_FRAMES = re.sub(r'\d+\.', lambda m: '?' * (len(m.group()) - 1) + '.', NAME_TEMPLATE_OF_DATA_FRAMES)
+            NAME_TEMPLATE_OF_DATA_FRAMES = _DIGITS_RE.sub(_digits_to_wildcard, NAME_TEMPLATE_OF_DATA_FRAMES)
         logger.info(f"Template for data frames: {NAME_TEMPLATE_OF_DATA_FRAMES}")
         filling_template_rotational(folder_with_raw_data, current_data_processing_folder, ORGX, ORGY,
                         distance_offset, NAME_TEMPLATE_OF_DATA_FRAMES, command_for_data_processing,
                         XDS_INP_template)
-        login_node = None
-        if "maxwell" not in reserved_nodes:
-            login_node = reserved_nodes.split(",")[0] if "," in reserved_nodes else reserved_nodes
+        login_node = get_login_node(reserved_nodes)
 
         logger.info(f"Login node for processing: {login_node}")
         # Running XDS
         logger.info(f"Running XDS in {current_data_processing_folder}/xds")
-        xds_start(os.path.join(current_data_processing_folder,'xds'), 'xds_par',
-        user, reserved_nodes, slurm_partition, sshPrivateKeyPath, sshPublicKeyPath, login_node=login_node)
+        xds_slurmfile = write_sbatch(os.path.join(current_data_processing_folder,'xds'), 'xds_par',
+                                     reserved_nodes, slurm_partition)
         #running autoPROC
         logger.info(f"Running autoPROC in {unique_dir}")
         command_for_data_processing = f"process -d {unique_dir}/autoPROC -I {folder_with_raw_data}"
-        xds_start(unique_dir, f'{command_for_data_processing}',
-                user, "maxwell", slurm_partition, sshPrivateKeyPath, sshPublicKeyPath, login_node=login_node)
-        
-    
+        autoproc_slurmfile = write_sbatch(unique_dir, command_for_data_processing, "maxwell", slurm_partition)
+        # Both jobs go out through one ssh session
+        ssh_command = build_ssh_command(user, sshPrivateKeyPath, login_node) if login_node else None
+        submit_jobs([xds_slurmfile, autoproc_slurmfile], ssh_command)
+
         Path(current_data_processing_folder, 'flag.txt').touch()
@@ -5,54 +5,159 @@
 import os
 import re
 import glob
-import shlex
 import shutil
 import subprocess
 import sys
 from pathlib import Path
 from string import Template
-from utils.nodes import are_the_reserved_nodes_overloaded
+from utils.nodes import are_the_reserved_nodes_overloaded_cached, submit_jobs, get_login_node
 from utils.templates import filling_template_serial
-from utils.log_setup import setup_logger
+from utils.log_setup import setup_logger, find_processed_root
+from utils.ssh import build_ssh_command
+from utils.watch import wait_for_path
+from concurrent.futures import ThreadPoolExecutor
 import time
 import logging
 
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
 split_lines = 250
 chunk_size = 1000
+max_parallel_array_tasks = 50
+write_chunk_size = 1 << 20 # [bytes]
+h5_reader_threads = 8
 sleep_time = 5
 time_to_wait_appearing_raw_folder = 20
 
+logger = logging.getLogger('app')
+
+# Frame index of raw file names like name_00042.cbf
+_FRAME_INDEX_RE = re.compile(r"_(\d+)\.(h5|cbf)$")
+# Global data path and multi-event layout of a CrystFEL geometry file
+_GEOM_DATA_RE = re.compile(r"^\s*data\s*=\s*(\S+)", re.M)
+_GEOM_EVENT_DIM_RE = re.compile(r"^\s*dim0\s*=\s*%\s*$", re.M)
+
+def find_h5_and_cbf_files(folder):
+    """Recursively collect .h5 and .cbf files below folder in one directory traversal.
+    Returns:
+        tuple: (list of .h5 paths, list of .cbf paths), unsorted.
+    """
+    h5_files = []
+    cbf_files = []
+    folders = [folder]
+    while folders:
+        with os.scandir(folders.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                elif entry.name.endswith(".h5"):
+                    h5_files.append(entry.path)
+                elif entry.name.endswith(".cbf"):
+                    cbf_files.append(entry.path)
+    return h5_files, cbf_files
+
+def find_h5_and_cbf_files_in_range(folder, data_range):
+    """Collect .h5 and .cbf files of folder whose trailing frame index is in data_range.
+    Args:
+        folder (str): Raw data folder.
+        data_range (range): Frame indices to keep.
+    Returns:
+        tuple: (sorted list of .h5 paths, sorted list of .cbf paths).
+    """
+    h5_files = []
+    cbf_files = []
+    with os.scandir(folder) as it:
+        for entry in it:
+            match = _FRAME_INDEX_RE.search(entry.name)
+            if match is None or int(match.group(1)) not in data_range:
+                continue
+            if match.group(2) == "h5":
+                h5_files.append(entry.path)
+            else:
+                cbf_files.append(entry.path)
+    return sorted(h5_files), sorted(cbf_files)
+
+def write_file_list(path, files):
+    """Write one path per line with unbuffered writes of about write_chunk_size bytes.
+    Args:
+        path (str): List file to (re)create.
+        files (list): Paths to write; an empty list leaves an empty file.
+    """
+    blob = memoryview(b"".join(os.fsencode(file) + b"\n" for file in files))
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        # Round the chunk to a multiple of the filesystem block size
+        block_size = os.fstatvfs(fd).f_bsize or 4096
+        step = max(block_size, write_chunk_size // block_size * block_size)
+        while blob:
+            blob = blob[os.write(fd, blob[:step]):]
+    finally:
+        os.close(fd)
+
+def _count_events(h5_file, data_path):
+    # Files may still be written by the detector; None makes the caller fall back to list_events
+    try:
+        with h5py.File(h5_file, "r") as f:
+            dataset = f[data_path]
+            return dataset.shape[0] if dataset.ndim == 3 else None
+    except (OSError, KeyError):
+        return None
+
+def list_events_h5(list_h5, geom, list_events_file):
+    """Python replacement of CrystFEL list_events for Eiger-like multi-event HDF5 files.
+    Only handles geometries with one data path and dim0 = %; anything else is left to list_events.
+    Args:
+        list_h5 (Path): File with one .h5 path per line.
+        geom (Path): CrystFEL geometry file.
+        list_events_file (Path): Output file, one "file //event" per line.
+    Returns:
+        bool: False if the case is not handled and list_events has to be run instead.
+    """
+    if h5py is None:
+        return False
+    geometry = Path(geom).read_text()
+    data_path = _GEOM_DATA_RE.search(geometry)
+    if data_path is None or "%" in data_path.group(1) or not _GEOM_EVENT_DIM_RE.search(geometry):
+        return False
+
+    h5_files = Path(list_h5).read_text().split()
+    # h5py releases the GIL while reading metadata, so the files are opened concurrently
+    with ThreadPoolExecutor(max_workers=h5_reader_threads) as executor:
+        n_events = list(executor.map(_count_events, h5_files, [data_path.group(1)] * len(h5_files)))
+    if None in n_events:
+        return False
+
+    write_file_list(list_events_file, [f"{h5_file} //{i}" for h5_file, n in zip(h5_files, n_events) for i in range(n)])
+    return True
+
 def serial_data_processing(folder_with_raw_data, current_data_processing_folder,
                             cell_file, indexing_method, user, reserved_nodes, slurm_partition, 
                             sshPrivateKeyPath, sshPublicKeyPath, data_range=None, iteration=0):
     """Prepare and submit the serial data processing job."""
 
-    logger = logging.getLogger('app')
-
     job_name = Path(current_data_processing_folder).name
     logger.info(f"Starting serial data processing for job: {job_name}")
     
     raw = folder_with_raw_data
-    proc = current_data_processing_folder
+    proc = Path(current_data_processing_folder).absolute()
     pdb = cell_file if cell_file else ""
     
     geom = "geometry.geom"
     
-    os.chdir(proc)
     os.chmod(proc, 0o777)
     
-    # Create directories
+    # Create directories, names stay relative for the job script which runs in proc
     stream_dir = Path("streams")
     error_dir = Path("error")
     joined_stream_dir = Path("j_stream")
     for d in [stream_dir, error_dir, joined_stream_dir]:
-        d.mkdir(exist_ok=True)
+        (proc / d).mkdir(exist_ok=True)
 
-    name1 = Path(proc).name
+    name1 = proc.name
     
-    # Load modules
-    subprocess.run("source /etc/profile.d/modules.sh && module load maxwell xray crystfel", shell=True, executable='/bin/bash')
-
     # Find files
 
     cbf_files_to_process = []
@@ -61,39 +166,29 @@ def serial_data_processing(folder_with_raw_data, current_data_processing_folder,
     if not data_range:
         list_h5 = "list_h5.lst"
         list_cbf = "list_cbf.lst"
-        with open(list_h5, "w") as f:
-            subprocess.run(f"find {raw} -name '*.h5' | sort", shell=True, stdout=f)
-        with open(list_cbf, "w") as f:
-            subprocess.run(f"find {raw} -name '*.cbf' | sort", shell=True, stdout=f)
+        h5_files, cbf_files = find_h5_and_cbf_files(raw)
+        write_file_list(proc / list_h5, sorted(h5_files))
+        write_file_list(proc / list_cbf, sorted(cbf_files))
     else:
         list_h5 = f"list_h5_{iteration}.lst"
         list_cbf = f"list_cbf_{iteration}.lst"
         time.sleep(sleep_time)
-        cbf_files = glob.glob(f"{raw}/*.cbf")
-        h5_files = glob.glob(f"{raw}/*.h5")
-
-        cbf_files_to_process = sorted([file for file in cbf_files if int(file.split(".")[0].split("_")[-1]) in data_range])
-        h5_files_to_process = sorted([file for file in h5_files if int(file.split(".")[0].split("_")[-1]) in data_range])
-        
-        with open(list_cbf, "w") as f:
-            f.write("\n".join(cbf_files_to_process))
-
-        with open(list_h5, "w") as f:
-            f.write("\n".join(h5_files_to_process))
+        h5_files_to_process, cbf_files_to_process = find_h5_and_cbf_files_in_range(raw, data_range)
+        write_file_list(proc / list_cbf, cbf_files_to_process)
+        write_file_list(proc / list_h5, h5_files_to_process)
     
     last_file = cbf_files_to_process[-1] if cbf_files_to_process else (h5_files_to_process[-1] if h5_files_to_process else None)
 
     if last_file:
-        while not os.path.exists(last_file):
-            time.sleep(5)
+        wait_for_path(last_file, sleep_time)
 
     # Determine filetype
     filetype = 0
-    if os.path.getsize(list_h5) > 0:
+    if os.path.getsize(proc / list_h5) > 0:
         logger.info("Found h5 files")
         filetype = 1
 
-    if os.path.getsize(list_cbf) > 0:
+    if os.path.getsize(proc / list_cbf) > 0:
         logger.info("Found cbf files")
         filetype = 2
 
@@ -102,69 +197,77 @@ def serial_data_processing(folder_with_raw_data, current_data_processing_folder,
         sys.exit(0)
 
     # Convert list if necessary
-    if filetype == 1:
-        subprocess.run(f"list_events -i {list_h5} -g {geom} -o {list_cbf}", shell=True)
-
-    # Split input file
-    split_prefix = f"events-{name1}.lst"
-    subprocess.run(f"split -a 3 -d -l {split_lines} {list_cbf} {split_prefix}", shell=True)
-    logger.info(f"Split input file into chunks with prefix: {split_prefix}")
-    # Create and submit SLURM jobs
-    for split_file in sorted(Path(".").glob(f"{split_prefix}*")):
-        suffix = split_file.name.replace(f"events-{name1}.lst", "")
-        name = f"{name1}{suffix}"
-        stream = f"{name1}.stream{suffix}"
-        slurmfile = f"{name}.sh"
-        err_file = Path(current_data_processing_folder) / f"{error_dir}/{name}_serial.err"
-        out_file = Path(current_data_processing_folder) / f"{error_dir}/{name}_serial.out"
-
-        logger.info(f"Processing {split_file.name} -> {stream}")
-        with open(slurmfile, "w") as f:
-            sbatch_command = "#!/bin/sh\n"
-            sbatch_command += f"#SBATCH --job-name={name}\n"
-            sbatch_command += f"#SBATCH --output={out_file}\n"
-            sbatch_command += f"#SBATCH --error={err_file}\n"
-            if "maxwell" not in reserved_nodes:
-                login_node = reserved_nodes.split(",")[0] if "," in reserved_nodes else reserved_nodes
-                reserved_nodes_overloaded = are_the_reserved_nodes_overloaded(reserved_nodes)
-
-                ssh_command = (
-                    f"/usr/bin/ssh -o BatchMode=yes -o CheckHostIP=no -o StrictHostKeyChecking=no "
-                    f"-o GSSAPIAuthentication=no -o GSSAPIDelegateCredentials=no "
-                    f"-o PasswordAuthentication=no -o PubkeyAuthentication=yes "
-                    f"-o PreferredAuthentications=publickey -o ConnectTimeout=10 "
-                    f"-l {user} -i {sshPrivateKeyPath} {login_node}"
-                )
-                if not reserved_nodes_overloaded:
-                    sbatch_command += f"#SBATCH --partition={slurm_partition}\n"
-                    sbatch_command += f"#SBATCH --reservation={reserved_nodes}\n"
-                else:
-                    sbatch_command += f"#SBATCH --partition=allcpu,upex,short\n"
-            else:
-                ssh_command = ""
-                sbatch_command += "#SBATCH --partition=allcpu,upex,short\n"
-                sbatch_command += "#SBATCH --time=4:00:00\n"
-                sbatch_command += "#SBATCH --nodes=1\n"
-                sbatch_command += "#SBATCH --nice=100\n"
-                sbatch_command += "#SBATCH --mem=500000\n"
-            
-            sbatch_command += "module load maxwell xray crystfel\n"
-
-            indexing_command = f"indexamajig -i {split_file.name} -o {stream_dir}/{stream} -j 80 -g {geom} --int-radius=3,6,8"
-            indexing_command += " --peaks=peakfinder8 --min-snr=8 --min-res=10 --max-res=1200 --threshold=5"
-            indexing_command += " --min-pix-count=1 --max-pix-count=10 --min-peaks=15 --local-bg-radius=3"
-            indexing_command += f" --indexing={indexing_method} --no-check-cell --multi"
-            if pdb:
-                indexing_command += f" -p {pdb}"
-
-            f.write(sbatch_command + "\n" + indexing_command + "\n")
-            f.write(f"touch {name}.done\n")
-        os.chmod(slurmfile, 0o755)
-        # Submit the job  
-        if ssh_command:
-            subprocess.run(f'{ssh_command} "sbatch {slurmfile}"', shell=True, check=True)
+    if filetype == 1 and not list_events_h5(proc / list_h5, proc / geom, proc / list_cbf):
+        subprocess.run(["list_events", "-i", list_h5, "-g", geom, "-o", list_cbf], cwd=proc)
+
+    # Split input file, per iteration so queued jobs of earlier chunks keep their input
+    split_prefix = f"events-{name1}.lst" if not data_range else f"events-{name1}_{iteration}.lst"
+    for old_split_file in proc.glob(f"{split_prefix}*"):
+        old_split_file.unlink()
+    subprocess.run(["split", "-a", "3", "-d", "-l", str(split_lines), list_cbf, split_prefix], cwd=proc)
+    n_split_files = len(list(proc.glob(f"{split_prefix}*")))
+    logger.info(f"Split input file into {n_split_files} chunks with prefix: {split_prefix}")
+    if n_split_files == 0:
+        return
+
+    # Cluster state is the same for every split file, query it once
+    ssh_command = None
+    if "maxwell" not in reserved_nodes:
+        login_node = get_login_node(reserved_nodes)
+        reserved_nodes_overloaded = are_the_reserved_nodes_overloaded_cached(reserved_nodes)
+        ssh_command = build_ssh_command(user, sshPrivateKeyPath, login_node)
+
+    # One job array over all split files, task N processes {split_prefix}NNN
+    name = split_prefix.replace("events-", "").replace(".lst", "")
+    stream = f"{name}.stream"
+    slurmfile = f"{name}.sh"
+    # %3a is the zero-padded array index, the same suffix split gives the files
+    err_file = proc / error_dir / f"{name}%3a_serial.err"
+    out_file = proc / error_dir / f"{name}%3a_serial.out"
+
+    logger.info(f"Processing {split_prefix}000-{n_split_files - 1:03d} -> {stream_dir}/{stream}*")
+    if "maxwell" not in reserved_nodes:
+        if not reserved_nodes_overloaded:
+            resources = f"#SBATCH --partition={slurm_partition}\n#SBATCH --reservation={reserved_nodes}\n"
         else:
-            subprocess.run(f'sbatch {slurmfile}', shell=True, check=True)
+            resources = "#SBATCH --partition=allcpu,upex,short\n"
+    else:
+        resources = (
+            "#SBATCH --partition=allcpu,upex,short\n"
+            "#SBATCH --time=4:00:00\n"
+            "#SBATCH --nodes=1\n"
+            "#SBATCH --nice=100\n"
+            "#SBATCH --mem=500000\n"
+        )
+
+    indexing_command = (
+        f"indexamajig -i {split_prefix}$SUFFIX -o {stream_dir}/{stream}$SUFFIX -j 80 -g {geom} --int-radius=3,6,8"
+        " --peaks=peakfinder8 --min-snr=8 --min-res=10 --max-res=1200 --threshold=5"
+        " --min-pix-count=1 --max-pix-count=10 --min-peaks=15 --local-bg-radius=3"
+        f" --indexing={indexing_method} --no-check-cell --multi"
+        f"{f' -p {pdb}' if pdb else ''}"
+    )
+
+    sbatch_command = (
+        "#!/bin/sh\n"
+        f"#SBATCH --job-name={name}\n"
+        f"#SBATCH --output={out_file}\n"
+        f"#SBATCH --error={err_file}\n"
+        f"#SBATCH --chdir={proc}\n"
+        f"#SBATCH --array=0-{n_split_files - 1}%{max_parallel_array_tasks}\n"
+        f"{resources}"
+        "source /etc/profile.d/modules.sh\n"
+        "module load maxwell xray crystfel\n"
+        "SUFFIX=$(printf '%03d' $SLURM_ARRAY_TASK_ID)\n"
+        "\n"
+        f"{indexing_command}\n"
+        f"touch {name}$SUFFIX.done\n"
+    )
+    (proc / slurmfile).write_text(sbatch_command)
+    os.chmod(proc / slurmfile, 0o755)
+
+    # Submit the job array
+    submit_jobs([proc / slurmfile], ssh_command)
 
 
 def serial_processing(
@@ -189,7 +292,7 @@ def serial_processing(
         
     
     # Setup logger
-    logger = setup_logger(log_dir=current_data_processing_folder.split('processed')[0] + 'processed', log_name="serial_processing")
+    logger = setup_logger(log_dir=str(find_processed_root(current_data_processing_folder)), log_name="serial_processing")
     
     logger.info("Starting serial data processing...")
     logger.info(f"Processing folder: {folder_with_raw_data}")
@@ -221,7 +324,7 @@ def serial_processing(
     iteration = 0
     for start_index in range(0, NFRAMES, chunk_size):
         end_index = min(start_index + chunk_size, NFRAMES)
-        data_range = list(range(start_index, end_index))
+        data_range = range(start_index, end_index)
         logger.info(f"Processing frames from {start_index} to {end_index} (data range: {data_range})")
         
         # Call the serial data processing function    
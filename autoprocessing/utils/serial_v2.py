@@ -5,7 +5,6 @@
 import os
 import re
 import glob
-import shlex
 import shutil
 import subprocess
 import sys
@@ -21,6 +20,8 @@ split_lines = 250
 chunk_size = 1000
 sleep_time = 5
 
+logger = logging.getLogger('app')
+
 def get_files_in_range(raw_dir, ext, data_range):
     files = glob.glob(f"{raw_dir}/*.{ext}")
     return sorted([f for f in files if int(Path(f).stem.split("_")[-1]) in data_range])
@@ -33,8 +34,6 @@ def serial_data_processing(folder_with_raw_data, current_data_processing_folder,
     
     
     current_chunk_size = len(data_range)
-    
-    logger = logging.getLogger('app')
 
     job_name = Path(current_data_processing_folder).name
     logger.info(f"Starting serial data processing for job: {job_name}")
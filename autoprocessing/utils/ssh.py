@@ -0,0 +1,22 @@
+import shutil
+
+# Resolved once so ssh is exec'd directly without a shell
+SSH = shutil.which("ssh") or "/usr/bin/ssh"
+
+# The first connection to a login node becomes a background master that later ssh calls,
+# from any process of this user, attach to until it has been idle for SSH_CONTROL_PERSIST
+SSH_CONTROL_PATH = "~/.ssh/cm-%r@%h:%p"
+SSH_CONTROL_PERSIST = 600 # [s]
+
+SSH_OPTIONS = [
+    "-o", "BatchMode=yes", "-o", "CheckHostIP=no", "-o", "StrictHostKeyChecking=no",
+    "-o", "GSSAPIAuthentication=no", "-o", "GSSAPIDelegateCredentials=no", "-o", "PasswordAuthentication=no",
+    "-o", "PubkeyAuthentication=yes", "-o", "PreferredAuthentications=publickey", "-o", "ConnectTimeout=10",
+    "-o", "ControlMaster=auto", "-o", f"ControlPath={SSH_CONTROL_PATH}", "-o", f"ControlPersist={SSH_CONTROL_PERSIST}",
+]
+
+def build_ssh_command(user, sshPrivateKeyPath, login_node):
+    """Build the ssh argv used to run commands on the login node; append the remote command to it.
+    The connection is multiplexed, so only the first call per login node pays for the handshake.
+    """
+    return [SSH, *SSH_OPTIONS, "-l", user, "-i", sshPrivateKeyPath, login_node]
@@ -1,12 +1,40 @@
 import os
 import shutil
+import functools
 from pathlib import Path
 from string import Template
 from utils.extract import extract_value_from_info
 from utils.UC import parse_UC_file, parse_cryst1_and_spacegroup_number
 from utils.cbf_head_reader import retrieving_info_from_cbf
 from utils.resolution import calculation_high_resolution
-import glob
+
+@functools.lru_cache(maxsize=8)
+def _read_template(path, mtime_ns):
+    with open(path, 'r') as f:
+        return Template(f.read())
+
+def _load_template(path):
+    """Return the Template for path, reading the file only once while it stays unchanged."""
+    return _read_template(os.fspath(path), os.stat(path).st_mtime_ns)
+
+def _find_cell_file(folder):
+    """Return the first .cell file of folder, else the first .pdb file, else None."""
+    folder = Path(folder)
+    cell_file = next(folder.glob("*.cell"), None) or next(folder.glob("*.pdb"), None)
+    return str(cell_file) if cell_file else None
+
+@functools.lru_cache(maxsize=64)
+def _read_cell(folder, mtime_ns):
+    cell_file = _find_cell_file(folder)
+    if cell_file:
+        return parse_UC_file(cell_file)
+    return None, None, None, None, None, None, 0
+
+def _cell_for(folder):
+    """Return (a, b, c, alpha, beta, gamma, SPACE_GROUP_NUMBER) of the cell/pdb file in folder.
+    Discovery and parsing run once while the folder is unchanged, e.g. for all wedges positions.
+    """
+    return _read_cell(os.fspath(folder), os.stat(folder).st_mtime_ns)
 
 def filling_template_rotational(folder_with_raw_data, current_data_processing_folder, ORGX=0, ORGY=0,
                     DISTANCE_OFFSET=0, NAME_TEMPLATE_OF_DATA_FRAMES='blabla',
@@ -15,8 +43,6 @@ def filling_template_rotational(folder_with_raw_data, current_data_processing_fo
     folder_with_raw_data = Path(folder_with_raw_data)
     current_data_processing_folder = Path(current_data_processing_folder)
 
-    shutil.copy(XDS_INP_template, current_data_processing_folder / 'xds/template.INP')
-
     info_path = folder_with_raw_data / 'info.txt'
     if not info_path.exists() or info_path.stat().st_size == 0:
         print(f"Error: info.txt not found or empty in {folder_with_raw_data}")
@@ -34,17 +60,7 @@ def filling_template_rotational(folder_with_raw_data, current_data_processing_fo
     OSCILLATION_RANGE = extract_value_from_info(info_path, "degrees/frame")
     WAVELENGTH = extract_value_from_info(info_path, "wavelength")
 
-    cell_matches = glob.glob(str(Path(folder_with_raw_data) / "*.cell"))
-    if cell_matches:
-        cell_file = cell_matches[0]
-        a, b, c, alpha, beta, gamma, SPACE_GROUP_NUMBER = parse_UC_file(cell_file)
-    else:
-        pdb_matches = glob.glob(str(Path(folder_with_raw_data) / "*.pdb"))
-        if pdb_matches:
-            cell_file = pdb_matches[0]
-            a, b, c, alpha, beta, gamma, SPACE_GROUP_NUMBER = parse_UC_file(cell_file)
-        else:
-            a, b, c, alpha, beta, gamma, SPACE_GROUP_NUMBER = None, None, None, None, None, None, 0
+    a, b, c, alpha, beta, gamma, SPACE_GROUP_NUMBER = _cell_for(folder_with_raw_data)
     template_data = {
         "DETECTOR_DISTANCE": DETECTOR_DISTANCE,
         "ORGX": ORGX,
@@ -58,12 +74,10 @@ def filling_template_rotational(folder_with_raw_data, current_data_processing_fo
         "UNIT_CELL_CONSTANTS": f"UNIT_CELL_CONSTANTS = {a:.2f} {b:.2f} {c:.2f} {alpha:.2f} {beta:.2f} {gamma:.2f}" if None not in [a, b, c, alpha, beta, gamma] else "!UNIT_CELL_CONSTANTS",
     }
 
-    with open(current_data_processing_folder / 'xds/template.INP', 'r') as f:
-        src = Template(f.read())
+    src = _load_template(XDS_INP_template)
     with open(current_data_processing_folder / 'xds/XDS.INP', 'w') as f:
         f.write(src.substitute(template_data))
     os.chmod(current_data_processing_folder/ 'xds/XDS.INP', 0o777)
-    os.remove(current_data_processing_folder / 'xds/template.INP')
     
 
 def filling_template_serial(folder_with_raw_data, current_data_processing_folder,
@@ -71,10 +85,7 @@ def filling_template_serial(folder_with_raw_data, current_data_processing_folder
                     ORGX=0, ORGY=0, DISTANCE_OFFSET=0,
                     cell_file=None):
     """Fills the geometry template with parameters extracted from info.txt and prepares for data processing."""
-    
-    os.chdir(current_data_processing_folder)
-    template_geom_path = Path(current_data_processing_folder) / 'template.geom'
-    shutil.copy(geometry_filename_template, template_geom_path)
+    current_data_processing_folder = Path(current_data_processing_folder)
 
     info_path = Path(folder_with_raw_data) / 'info.txt'
     if not info_path.exists() or info_path.stat().st_size == 0:
@@ -83,9 +94,6 @@ def filling_template_serial(folder_with_raw_data, current_data_processing_folder
     #copy info.txt in the processed folder
     shutil.copy(info_path, current_data_processing_folder / 'info.txt')
     
-    with open(info_path) as f:
-        content = f.read()
-
     DETECTOR_DISTANCE = extract_value_from_info(info_path, "distance") + DISTANCE_OFFSET
     DETECTOR_DISTANCE /= 1000
     ORGX = ORGX or extract_value_from_info(info_path, "ORGX")
@@ -98,13 +106,7 @@ def filling_template_serial(folder_with_raw_data, current_data_processing_folder
     
     if not cell_file:
         # Try to find a .cell or .pdb file in the raw data folder
-        cell_matches = glob.glob(str(Path(folder_with_raw_data) / "*.cell"))
-        if cell_matches:
-            cell_file = cell_matches[0]
-        else:
-            pdb_matches = glob.glob(str(Path(folder_with_raw_data) / "*.pdb"))
-            if pdb_matches:
-                cell_file = pdb_matches[0]
+        cell_file = _find_cell_file(folder_with_raw_data)
 
     indexing_method = extract_value_from_info(info_path, "indexing_method", fallback="mosflm-latt-nocell", is_string=True)
     template_data = {
@@ -115,13 +117,10 @@ def filling_template_serial(folder_with_raw_data, current_data_processing_folder
         "data_h5path": data_h5path
     }
 
-    with open(template_geom_path, 'r') as f:
-        src = Template(f.read())
+    src = _load_template(geometry_filename_template)
 
-    with open('geometry.geom', 'w') as monitor_file:
+    with open(current_data_processing_folder / 'geometry.geom', 'w') as monitor_file:
         monitor_file.write(src.substitute(template_data))
-
-    template_geom_path.unlink()
     
     return indexing_method, cell_file, NFRAMES
 
@@ -133,7 +132,6 @@ def filling_template_wedges(folder_with_raw_data, current_data_processing_folder
     """Fills the geometry template with parameters extracted from info.txt and prepares for data processing."""
     folder_with_raw_data = Path(folder_with_raw_data)
     current_data_processing_folder = Path(current_data_processing_folder)
-    shutil.copy(XDS_INP_template, current_data_processing_folder / 'xds/template.INP')
 
     info_path = folder_with_raw_data / 'info.txt'
     if not info_path.exists() or info_path.stat().st_size == 0:
@@ -150,24 +148,11 @@ def filling_template_wedges(folder_with_raw_data, current_data_processing_folder
     OSCILLATION_RANGE = extract_value_from_info(info_path, "degrees/frame")
     WAVELENGTH = extract_value_from_info(info_path, "wavelength")
 
-    cell_matches = glob.glob(str(Path(folder_with_raw_data) / "*.cell"))
-    if cell_matches:
-        cell_file = cell_matches[0]
-        a, b, c, alpha, beta, gamma, SPACE_GROUP_NUMBER = parse_UC_file(cell_file)
-    else:
-        pdb_matches = glob.glob(str(Path(folder_with_raw_data) / "*.pdb"))
-        if pdb_matches:
-            cell_file = pdb_matches[0]
-            a, b, c, alpha, beta, gamma, SPACE_GROUP_NUMBER = parse_UC_file(cell_file)
-        else:
-            a, b, c, alpha, beta, gamma, SPACE_GROUP_NUMBER = None, None, None, None, None, None, 0
+    a, b, c, alpha, beta, gamma, SPACE_GROUP_NUMBER = _cell_for(folder_with_raw_data)
             
     if REFERENCE_DATA_SET in ["!REFERENCE_DATA_SET", "None"]:
-        REFERENCE_DATA_SET_matches = glob.glob(str(Path(folder_with_raw_data) / "XDS_ASCII.HKL"))
-        if REFERENCE_DATA_SET_matches:
-            REFERENCE_DATA_SET = REFERENCE_DATA_SET_matches[0]
-        else:
-            REFERENCE_DATA_SET = "!REFERENCE_DATA_SET"
+        reference_hkl = folder_with_raw_data / "XDS_ASCII.HKL"
+        REFERENCE_DATA_SET = str(reference_hkl) if reference_hkl.exists() else "!REFERENCE_DATA_SET"
     
     cbf_to_open = NAME_TEMPLATE_OF_DATA_FRAMES.replace("?????", "00001")
     N_PIXELS_TO_THE_SHORT_EDGE, N_PIXELS_TO_THE_LONG_EDGE, pixel_size = retrieving_info_from_cbf(cbf_to_open)
@@ -188,9 +173,7 @@ def filling_template_wedges(folder_with_raw_data, current_data_processing_folder
         "ROTATION_AXIS": "1.0 0.0 0.0" if int(position) % 2 == 0 else "-1.0 0.0 0.0"
     }
 
-    with open(current_data_processing_folder / 'xds/template.INP', 'r') as f:
-        src = Template(f.read())
+    src = _load_template(XDS_INP_template)
     with open(current_data_processing_folder / 'xds/XDS.INP', 'w') as f:
         f.write(src.substitute(template_data))
 
-    os.remove(current_data_processing_folder / 'xds/template.INP')
@@ -0,0 +1,50 @@
+import os
+import time
+import threading
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+
+class DirectoryEventHandler(FileSystemEventHandler):
+    """Signals an event whenever something changes in the watched directory."""
+
+    def __init__(self):
+        super().__init__()
+        self.changed = threading.Event()
+
+    def on_any_event(self, event):
+        self.changed.set()
+
+def wait_for_path(path, poll_interval=1):
+    """Block until path exists, sleeping on inotify events of its parent instead of polling.
+    Falls back to checking every poll_interval seconds if watchdog is not installed
+    or the parent directory does not exist yet.
+    Args:
+        path (str): File or directory to wait for.
+        poll_interval (float): Maximum time between two checks in seconds.
+    """
+    if os.path.exists(path):
+        return
+    parent = os.path.dirname(os.path.normpath(path))
+    if Observer is None or not os.path.isdir(parent):
+        while not os.path.exists(path):
+            time.sleep(poll_interval)
+        return
+
+    handler = DirectoryEventHandler()
+    observer = Observer()
+    observer.schedule(handler, parent, recursive=False)
+    observer.start()
+    try:
+        # The timeout keeps us safe against events missed before the watch was set up
+        while not os.path.exists(path):
+            handler.changed.wait(poll_interval)
+            handler.changed.clear()
+    finally:
+        observer.stop()
+        observer.join()
@@ -3,29 +3,26 @@
 # Written by Galchenkova M., Tolstikova A., Yefanov O., 2022 (revised)
 
 import os
-import sys
 import time
-import math
-import fabio
 import glob
 import re
-import shutil
-import subprocess
-import logging
-from string import Template
+import hashlib
 from pathlib import Path
-from collections import defaultdict
-import shlex
-from utils.nodes import are_the_reserved_nodes_overloaded
-from utils.UC import parse_UC_file, parse_cryst1_and_spacegroup_number
-from utils.extract import extract_value_from_info
+from concurrent.futures import ThreadPoolExecutor
+from utils.nodes import are_the_reserved_nodes_overloaded_cached, submit_jobs, get_login_node, SLURM_HEADER
 from utils.templates import filling_template_wedges
-from utils.log_setup import setup_logger
+from utils.log_setup import setup_logger, find_processed_root
+from utils.ssh import build_ssh_command
 
-SLEEP_TIME = 10 
 time_to_wait_appearing_raw_folder = 20
+max_parallel_array_tasks = 50
+max_preparation_threads = 16
+
+# Wedge frames are named <prefix>_<position:6 digits>_<frame:5 digits>.cbf
+_CBF_RE = re.compile(r"^(.*)_(\d{6})_(\d{5})\.cbf$")
 
 def xds_start(
+    xds_folders,
     current_data_processing_folder,
     command_for_data_processing,
     user,
@@ -35,17 +32,15 @@ def xds_start(
     ssh_public_key_path,
     login_node=None
 ):
-    """Prepare and submit the XDS job."""
-    os.chdir(current_data_processing_folder)
+    """Prepare and submit one XDS job array, task N runs in the N-th folder of xds_folders.
+    The folder list is part of the script itself: SLURM keeps a copy of it per submission,
+    so queued tasks of an earlier array are not affected by a later call for the same dataset.
+    """
     
     def get_slurm_header(partition, reservation=None, extras=None):
         lines = [
-            "#!/bin/sh\n",
-            f"#SBATCH --job-name={job_name}\n",
-            f"#SBATCH --partition={partition}\n",
-            "#SBATCH --nodes=1\n",
-            f"#SBATCH --output={out_file}\n",
-            f"#SBATCH --error={err_file}\n"
+            SLURM_HEADER.substitute(job_name=job_name, partition=partition, out_file=out_file, err_file=err_file),
+            f"#SBATCH --array=0-{len(xds_folders) - 1}%{max_parallel_array_tasks}\n"
         ]
         if reservation:
             lines.append(f"#SBATCH --reservation={reservation}\n")
@@ -55,26 +50,34 @@ def xds_start(
 
     def get_common_xds_commands():
         return [
+            # Each task picks its position folder and keeps its logs there
+            "case $SLURM_ARRAY_TASK_ID in\n",
+            *(f"    {index}) XDS_DIR=\"{xds_folder}\" ;;\n" for index, xds_folder in enumerate(xds_folders)),
+            "    *) XDS_DIR= ;;\n",
+            "esac\n",
+            "[ -n \"$XDS_DIR\" ] || exit 1\n",
+            "cd \"$XDS_DIR\" || exit 1\n",
+            "exec > xds_XDS.out 2> xds_XDS.err\n",
             "source /etc/profile.d/modules.sh\n",
             "module load xray\n",
             f"{command_for_data_processing}\n",
-            f"sleep {SLEEP_TIME}\n",
-            f"cd {current_data_processing_folder}\n",
             "cp GXPARM.XDS XPARM.XDS\n",
             "cp XDS_ASCII.HKL XDS_ASCII.HKL_1\n",
             "mv CORRECT.LP CORRECT.LP_1\n",
-            "sed -i 's/ JOB= XYCORR INIT/!JOB= XYCORR INIT/g' XDS.INP\n",
-            "sed -i 's/!JOB= CORRECT/ JOB= DEFPIX INTEGRATE CORRECT/g' XDS.INP\n",
+            "sed -i -e 's/ JOB= XYCORR INIT/!JOB= XYCORR INIT/g' -e 's/!JOB= CORRECT/ JOB= DEFPIX INTEGRATE CORRECT/g' XDS.INP\n",
             f"{command_for_data_processing}\n"
         ]
 
-    job_name = Path(current_data_processing_folder).name
-    slurmfile = Path(current_data_processing_folder) / f"{job_name}_XDS.sh"
-    err_file = Path(current_data_processing_folder) / f"{job_name}_XDS.err"
-    out_file = Path(current_data_processing_folder) / f"{job_name}_XDS.out"
+    folder = Path(current_data_processing_folder).absolute()
+    job_name = folder.name
+    slurmfile = folder / f"{job_name}_XDS.sh"
+    xds_folders = [Path(xds_folder).absolute() for xds_folder in xds_folders]
+    # Per-task logs before the task switches to its own folder
+    err_file = folder / f"{job_name}_XDS_%3a.err"
+    out_file = folder / f"{job_name}_XDS_%3a.out"
 
     sbatch_file = []
-    ssh_command = ""
+    ssh_command = None
 
     is_maxwell = "maxwell" in reserved_nodes
 
@@ -88,29 +91,21 @@ def xds_start(
         sbatch_file += get_slurm_header("allcpu,upex", extras=slurm_extras)
         sbatch_file += get_common_xds_commands()
     else:
-        reserved_nodes_overloaded = are_the_reserved_nodes_overloaded(reserved_nodes)
+        reserved_nodes_overloaded = are_the_reserved_nodes_overloaded_cached(reserved_nodes)
         partition = slurm_partition if not reserved_nodes_overloaded else "allcpu,upex,short"
         reservation = reserved_nodes if not reserved_nodes_overloaded else None
         sbatch_file += get_slurm_header(partition, reservation)
         sbatch_file += get_common_xds_commands()
 
         if login_node:
-            ssh_command = (
-                f"/usr/bin/ssh -o BatchMode=yes -o CheckHostIP=no "
-                f"-o StrictHostKeyChecking=no -o GSSAPIAuthentication=no "
-                f"-o GSSAPIDelegateCredentials=no -o PasswordAuthentication=no "
-                f"-o PubkeyAuthentication=yes -o PreferredAuthentications=publickey "
-                f"-o ConnectTimeout=10 -l {user} -i {ssh_private_key_path} {login_node}"
-            )
+            ssh_command = build_ssh_command(user, ssh_private_key_path, login_node)
 
     # Write SLURM file
-    with open(slurmfile, 'w') as fh:
-        fh.writelines(sbatch_file)
+    slurmfile.write_text("".join(sbatch_file))
     os.chmod(slurmfile, 0o755)
 
-    # Submit the job
-    submit_command = f'{ssh_command} "sbatch {slurmfile}"' if ssh_command else f'sbatch {slurmfile}'
-    subprocess.run(submit_command, shell=True, check=True)
+    # Submit the job array
+    submit_jobs([slurmfile], ssh_command)
 
 def group_cbf_by_position(folder):
     """Groups CBF files by their position and frame numbers.
@@ -120,35 +115,36 @@ def group_cbf_by_position(folder):
         dict: A dictionary where keys are position strings and values are dictionaries with 'start', 'end', and 'template'.
     """
     
-    position_frames = defaultdict(list)
-    templates = {}
-    for filename in os.listdir(folder):
-        if not filename.endswith(".cbf"):
-            continue
-        # Match pattern ending in _######_######.cbf
-        match = re.search(r"^(.*)_(\d{6})_(\d{5})\.cbf$", filename)
-        if not match:
-            continue
-        prefix, position_str, frame_str = match.groups()
-        try:
-            position = int(position_str)
+    # position -> [first frame, last frame, template], updated while scanning instead of keeping every frame
+    positions = {}
+    with os.scandir(folder) as it:
+        for entry in it:
+            filename = entry.name
+            # is_file uses the type from the directory listing, so skipping directories costs no stat
+            if not filename.endswith(".cbf") or not entry.is_file(follow_symlinks=False):
+                continue
+            match = _CBF_RE.match(filename)
+            if not match:
+                continue
+            prefix, position_str, frame_str = match.groups()
             frame = int(frame_str)
-        except ValueError:
-            continue
-        position_frames[position].append(frame)
-        if position not in templates:
-            # Reconstruct template using the matched prefix and position
-            template = os.path.join(folder, f"{prefix}_{position_str}_?????.cbf")
-            templates[position] = template
-    results = {}
-    for position, frames in position_frames.items():
-        pos_str = f"{position:06d}"
-        results[pos_str] = {
-            "start": min(frames),
-            "end": max(frames),
-            "template": templates[position]
-        }
-    return results
+            state = positions.get(position_str)
+            if state is None:
+                # Reconstruct template using the matched prefix and position
+                positions[position_str] = [frame, frame, os.path.join(folder, f"{prefix}_{position_str}_?????.cbf")]
+            elif frame < state[0]:
+                state[0] = frame
+            elif frame > state[1]:
+                state[1] = frame
+    return {
+        position_str: {"start": first_frame, "end": last_frame, "template": template}
+        for position_str, (first_frame, last_frame, template) in positions.items()
+    }
+
+
+def _position_key(data, *parameters):
+    """Hash the frames of a position together with the processing parameters, stored in its flag.txt."""
+    return hashlib.sha1(repr((data['template'], data['start'], data['end'], *parameters)).encode()).hexdigest()
 
 
 def wedges_processing(
@@ -164,16 +160,19 @@ def wedges_processing(
     reserved_nodes,
     slurm_partition,
     sshPrivateKeyPath,
-    sshPublicKeyPath
+    sshPublicKeyPath,
+    is_force=False
     ):
-    """Main function to process command line arguments and call the filling_template_wedges function."""
+    """Main function to process command line arguments and call the filling_template_wedges function.
+    With is_force, positions are processed again even if their flag.txt matches the current inputs.
+    """
     
     while not os.path.exists(folder_with_raw_data)  and len(glob.glob(folder_with_raw_data + '/*.cbf')) < 1000:
         logger.info(f"Waiting for the folder {folder_with_raw_data} to be available...")
         time.sleep(time_to_wait_appearing_raw_folder)
     
     # Setup logger
-    logger = setup_logger(log_dir=current_data_processing_folder.split('processed')[0] + 'processed', log_name="wedges_processing")
+    logger = setup_logger(log_dir=str(find_processed_root(current_data_processing_folder)), log_name="wedges_processing")
     
     logger.info("Starting wedges data processing...")
     logger.info(f"Processing folder: {folder_with_raw_data}")
@@ -195,37 +194,69 @@ def wedges_processing(
 
     if grouped_cbf:
         logger.info(f"Found {len(grouped_cbf)} positions with CBF files.")
-        for position, data in grouped_cbf.items():
+
+        def prepare_position(item):
+            position, data = item
             NAME_TEMPLATE_OF_DATA_FRAMES = data['template']
             first_image_index = data['start']
             last_image_index = data['end']
             processing_folder = os.path.join(current_data_processing_folder, position)
-            os.makedirs(processing_folder, exist_ok=True)
-            os.makedirs(os.path.join(processing_folder, 'xds'), exist_ok=True)
-            #os.makedirs(os.path.join(processing_folder, 'autoPROC'), exist_ok=True)
-            os.chmod(processing_folder, 0o777)
-            os.chmod(os.path.join(processing_folder, 'xds'), 0o777)
-            #os.chmod(os.path.join(processing_folder, 'autoPROC'), 0o777)
             logger.info(f"Processing position {position} with frames from {first_image_index} to {last_image_index}.")
             filling_template_wedges(folder_with_raw_data, processing_folder, ORGX, ORGY, position, 
                             first_image_index, last_image_index, REFERENCE_DATA_SET, distance_offset, 
                             NAME_TEMPLATE_OF_DATA_FRAMES, XDS_INP_template)
-            
-            login_node = None
-            if "maxwell" not in reserved_nodes:
-                login_node = reserved_nodes.split(",")[0] if "," in reserved_nodes else reserved_nodes
-
-            logger.info(f"Login node for processing: {login_node}")
-            # Running XDS
-            logger.info(f"Running XDS in {processing_folder}/xds")
-            xds_start(os.path.join(processing_folder,'xds'), 'xds_par',
-                    user, reserved_nodes, slurm_partition, sshPrivateKeyPath, sshPublicKeyPath, login_node=login_node)
 
             #running autoPROC
             #logger.info(f"Running autoPROC in {processing_folder}")
             #command_for_data_processing = f"process -d {os.path.join(current_data_processing_folder,'autoPROC')} -I {folder_with_raw_data}"
             #xds_start(os.path.join(processing_folder,'autoPROC'), f'{command_for_data_processing}',
             #        user, ["maxwell"], slurm_partition, sshPrivateKeyPath, sshPublicKeyPath, login_node=login_node)
-            
-            # Create flag file    
-            Path(processing_folder, 'flag.txt').touch()
+            return os.path.join(processing_folder, 'xds')
+
+        # Positions already submitted with identical inputs are not processed again, unless forced
+        template_mtime = os.stat(XDS_INP_template).st_mtime_ns
+        position_keys = {}
+        positions_to_process = []
+        for position, data in grouped_cbf.items():
+            position_keys[position] = _position_key(
+                data, template_mtime, ORGX, ORGY, distance_offset, REFERENCE_DATA_SET
+            )
+            if is_force:
+                is_done = False
+            else:
+                try:
+                    is_done = Path(current_data_processing_folder, position, 'flag.txt').read_text() == position_keys[position]
+                except OSError:
+                    is_done = False
+            if is_done:
+                logger.info(f"Skipping position {position}, already processed with the same parameters.")
+            else:
+                positions_to_process.append((position, data))
+        if not positions_to_process:
+            return
+
+        # Create the position folders world-writable straight away instead of chmod afterwards;
+        # umask is process-wide, so it is restored before the worker threads write any files
+        old_umask = os.umask(0)
+        try:
+            for position, _ in positions_to_process:
+                os.makedirs(os.path.join(current_data_processing_folder, position, 'xds'), mode=0o777, exist_ok=True)
+                #os.makedirs(os.path.join(current_data_processing_folder, position, 'autoPROC'), mode=0o777, exist_ok=True)
+        finally:
+            os.umask(old_umask)
+
+        # Preparing a position is file I/O only (CBF header, info.txt, XDS.INP), so positions overlap in threads
+        with ThreadPoolExecutor(max_workers=max_preparation_threads) as executor:
+            xds_folders = list(executor.map(prepare_position, positions_to_process))
+
+        login_node = get_login_node(reserved_nodes)
+
+        logger.info(f"Login node for processing: {login_node}")
+        # Running XDS, one array task per position
+        logger.info(f"Running XDS for {len(xds_folders)} positions in {current_data_processing_folder}")
+        xds_start(xds_folders, current_data_processing_folder, 'xds_par',
+                user, reserved_nodes, slurm_partition, sshPrivateKeyPath, sshPublicKeyPath, login_node=login_node)
+
+        # Create flag files holding the inputs they were submitted with
+        for (position, _), xds_folder in zip(positions_to_process, xds_folders):
+            Path(os.path.dirname(xds_folder), 'flag.txt').write_text(position_keys[position])
@@ -3,16 +3,10 @@
 # Written by Galchenkova M., Tolstikova A., Yefanov O., 2022 (revised)
 
 import os
-import sys
-import glob
-import gemmi
 import re
-import shutil
 import subprocess
-from string import Template
 from pathlib import Path
-import shlex
-from utils.nodes import are_the_reserved_nodess_overloaded
+from utils.nodes import are_the_reserved_nodes_overloaded
 from utils.templates import filling_template_rotational
 from utils.log_setup import setup_logger
 